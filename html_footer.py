@@ -18,9 +18,21 @@ Usage: html_footer.py [OPTION...]
                            valid levels: critical, error, warning,
                                          info, debug
     -l, --listen=HOST:IP   port to listen on (default: 127.0.0.1:10025)
-    -r, --remote=HOST:IP   relayhost to deliver to (default: 127.0.0.1:25)
+    -r, --remote=HOST:IP[,HOST:IP...]
+                           relayhosts to deliver to, may be given more
+                           than once (default: 127.0.0.1:25)
+    -a, --balance=STRATEGY how to choose a relayhost (default: roundrobin)
+                           valid strategies: roundrobin,
+                           latency (faster of two random relayhosts)
+    -c, --checkinterval=SECONDS
+                           check relayhosts and log their metrics every
+                           SECONDS, 0 disables checks (default: 30)
     -i, --imagepath=PATH   path for attachments (default: /var/lib/html_footer)
     -f, --logfile=FILENAME
+    -b, --logbuffer=SIZE   records buffered for the log writer thread,
+                           further records are dropped (default: 1000)
+    -s, --dumpsample=N     in daemon mode dump only every Nth message
+                           at debug level (default: 1)
     -k, --kill             kills daemon
     -p, --pidfile=FILENAME pidfile for daemon (default:
                                                /var/run/html_footer.pid)
@@ -71,9 +83,13 @@ from smtpd import PureProxy
 import asyncore
 
 import re
+import time
+from itertools import count
 from urlparse import urlparse
 
 from daemon import Daemon
+import logqueue
+import relays
 # Insert modification in email header
 X_HEADER = True
 
@@ -378,39 +394,83 @@ class MIMEChanger(object):
         return pload
 
 
+def refusal_reply(rcpttos, refused):
+    """SMTP answer for refused recipients, None if nothing was refused"""
+    if not refused:
+        return None
+    temporary = [code for code, resp in refused.values() if code < 500]
+    if len(refused) == len(rcpttos) and len(temporary) == len(refused):
+        # all relays busy or unreachable, let the client retry
+        return '451 relay temporarily unavailable'
+    return '550 content rejected:'
+
+
 class SMTPHTMLFooterServer(PureProxy):
     """Python's SMTP implementation"""
+    def _deliver(self, mailfrom, rcpttos, data):
+        """deliver to one of the relayhosts instead of a single remote"""
+        return relaypool.deliver(mailfrom, rcpttos, data)
+
     def process_message(self, peer, mailfrom, rcpttos, data):
         # TODO return error status (as SMTP answer string)
         # if something goes wrong!
+        start = time.time()
         try:
-            data = modify_data(data)
+            dump = next(msg_counter) % options.dumpsample == 0
+            data = modify_data(data, dump=dump)
+            modified = time.time()
             refused = self._deliver(mailfrom, rcpttos, data)
         except Exception as err:
             log.exception('Error on delivery: %s', err)
             return '550 content rejected: %s' % err
+        done = time.time()
         # TODO: what to do with refused addresses?
         # print >> DEBUGSTREAM, 'we got some refusals:', refused
         if refused:
             log.error('content refused: %s', pformat(refused))
-            return '550 content rejected:'
+        stats = {
+            'status': 'refused' if refused else 'delivered',
+            'peer': peer[0],
+            'rcpts': len(rcpttos),
+            'refused': len(refused),
+            'size': len(data),
+            'modify_ms': (modified - start) * 1000.0,
+            'deliver_ms': (done - modified) * 1000.0,
+        }
+        log.info('%(status)s peer=%(peer)s rcpts=%(rcpts)d '
+                 'refused=%(refused)d size=%(size)d '
+                 'modify_ms=%(modify_ms).1f deliver_ms=%(deliver_ms).1f',
+                 stats, extra=stats)
+        return refusal_reply(rcpttos, refused)
 
 
 class FooterDaemon(Daemon):
+    def daemonize(self):
+        # write pending records before forking, they would be duplicated
+        logwriter.flush()
+        Daemon.daemonize(self)
+
     def run(self):
+        logwriter.start()
+        if relaychecker:
+            relaychecker.start()
         asyncore.loop()
 
 
 class Options:
     uid = ''
     listen = ('127.0.0.1', 10025)
-    remote = ('127.0.0.1', 25)
+    remote = [('127.0.0.1', 25)]
+    balance = 'roundrobin'
+    checkinterval = 30
     debuglevel = logging.INFO
     cmd = 'start'
     pipemode = False
     pidfile = '/var/run/hmtl_footer.pid'
     imagepath = '/var/lib/html_footer'
     logfile = ''
+    logbuffer = 1000
+    dumpsample = 1
     txt2loglvl = {
         'critical': logging.CRITICAL,
         'error': logging.ERROR,
@@ -430,14 +490,16 @@ def usage(code, msg=''):
 def parseargs():
     try:
         opts, args = getopt.getopt(
-            sys.argv[1:], 'u:Vhpd:l:r:i:f:kp:',
+            sys.argv[1:], 'u:Vhpd:l:r:a:c:i:f:b:s:kp:',
             ['uid=', 'version', 'help', 'pipemode', 'debuglevel=',
-             'listen=', 'remote=', 'imagepath=', 'logfile=',
-             'kill', 'pidfile='])
+             'listen=', 'remote=', 'balance=', 'checkinterval=',
+             'imagepath=', 'logfile=',
+             'logbuffer=', 'dumpsample=', 'kill', 'pidfile='])
     except getopt.error as err:
         usage(1, err)
 
     options = Options()
+    remotes = []
     for opt, arg in opts:
         if opt in ('-h', '--help'):
             usage(0)
@@ -462,17 +524,42 @@ def parseargs():
             except ValueError:
                 usage(1, 'Bad local port: %s' % arg)
         elif opt in ('-r', '--remote'):
-            i = arg.find(':')
-            if i < 0:
-                usage(1, 'Bad remote address: %s' % arg)
+            for addr in arg.split(','):
+                i = addr.find(':')
+                if i < 0:
+                    usage(1, 'Bad remote address: %s' % addr)
+                try:
+                    remotes.append((addr[:i], int(addr[i+1:])))
+                except ValueError:
+                    usage(1, 'Bad remote port: %s' % addr)
+        elif opt in ('-a', '--balance'):
+            if arg in relays.RelayPool.STRATEGIES:
+                options.balance = arg
+            else:
+                usage(1, 'Unknown balance strategy %s' % arg)
+        elif opt in ('-c', '--checkinterval'):
             try:
-                options.remote = (arg[:i], int(arg[i+1:]))
+                options.checkinterval = float(arg)
             except ValueError:
-                usage(1, 'Bad remote port: %s' % arg)
+                usage(1, 'Bad check interval: %s' % arg)
         elif opt in ('-i', '--imagepath'):
             options.imagepath = arg
         elif opt in ('-f', '--logfile'):
             options.logfile = arg
+        elif opt in ('-b', '--logbuffer'):
+            try:
+                options.logbuffer = int(arg)
+            except ValueError:
+                usage(1, 'Bad log buffer size: %s' % arg)
+            if options.logbuffer < 1:
+                usage(1, 'Bad log buffer size: %s' % arg)
+        elif opt in ('-s', '--dumpsample'):
+            try:
+                options.dumpsample = int(arg)
+            except ValueError:
+                usage(1, 'Bad dump sample rate: %s' % arg)
+            if options.dumpsample < 1:
+                usage(1, 'Bad dump sample rate: %s' % arg)
         elif opt in ('-k', '--kill'):
             options.cmd = 'stop'
         elif opt in ('-p', '--pidfile'):
@@ -480,16 +567,20 @@ def parseargs():
         if len(args) > 0:
             usage(1, 'unknown arguments %s' % ', '.join(args))
 
+    if remotes:
+        options.remote = remotes
     return options
 
 
-def modify_data(msg_in):
+def modify_data(msg_in, dump=True):
     msg = email.message_from_string(msg_in)
     if mymime.msg_is_to_alter(msg):
         log.info('Msg(%s): altered', msg.get('Message-ID', ''))
         msg = mymime.alter_message(msg)
-        log.debug('Msg out:\n%s', msg.as_string(unixfrom=True))
-        return msg.as_string(unixfrom=True)
+        msg_out = msg.as_string(unixfrom=True)
+        if dump:
+            log.debug('Msg out:\n%s', msg_out)
+        return msg_out
     else:
         log.info('Msg(%s): nothing to alter', msg.get('Message-ID', ''))
         return msg_in
@@ -499,11 +590,12 @@ def modify_data(msg_in):
 #
 if __name__ == '__main__':
     options = parseargs()
-    logging.basicConfig(level=options.debuglevel, filename=options.logfile)
     log = logging.getLogger('html_footer')
 
     # use as simple pipe filter
     if options.pipemode:
+        logging.basicConfig(level=options.debuglevel,
+                            filename=options.logfile)
         msg_in = sys.stdin.read()
         log.debug('Msg in:\n%s', msg_in)
         try:
@@ -516,6 +608,15 @@ if __name__ == '__main__':
             sys.stdout.write(msg_in)
     # run as smtpd
     else:
+        # log records are written by a separate thread, started after fork
+        logwriter = logqueue.setup(options.debuglevel, options.logfile,
+                                   options.logbuffer)
+        msg_counter = count()
+        relaypool = relays.RelayPool(options.remote, options.balance)
+        relaychecker = None
+        if options.checkinterval > 0:
+            relaychecker = relays.RelayChecker(relaypool,
+                                               options.checkinterval)
         mymime = MIMEChanger()
         daemon = FooterDaemon(options.pidfile)
         if options.cmd == 'stop':
@@ -541,9 +642,12 @@ try running as pipe filter (-p).''')
 try running as pipe filer (-p).''', options.uid)
                 sys.exit(1)
         log.debug('Creating server instance')
-        server = SMTPHTMLFooterServer(options.listen, options.remote)
+        server = SMTPHTMLFooterServer(options.listen, options.remote[0])
         # if uid is given daemonize
         if options.uid:
             daemon.start()
         else:
+            logwriter.start()
+            if relaychecker:
+                relaychecker.start()
             asyncore.loop()
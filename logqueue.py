@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+Queue based logging, keeps disk and syslog writes off the asyncore loop
+"""
+
+import atexit
+import logging
+import threading
+import Queue
+
+
+class QueueHandler(logging.Handler):
+    """
+    Logging handler that never blocks the caller.
+
+    Records are put into a bounded queue and written by a QueueWriter
+    thread. If the queue is full the record is dropped and counted.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Render message and traceback in the calling thread, so the
+        record no longer references mutable arguments
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.acquire()
+            try:
+                self.dropped += 1
+            finally:
+                self.release()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class QueueWriter(threading.Thread):
+    """
+    Thread passing queued records to the real (blocking) handlers
+    """
+    _sentinel = None
+
+    def __init__(self, queue, handlers, source=None):
+        threading.Thread.__init__(self, name='logwriter')
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+        self.source = source
+        self.reported = 0
+
+    def handle(self, record):
+        """pass record to all handlers respecting their level"""
+        for hdl in self.handlers:
+            if record.levelno >= hdl.level:
+                hdl.handle(record)
+
+    def report_drops(self):
+        """log number of records lost since last report"""
+        if self.source is None:
+            return
+        self.source.acquire()
+        try:
+            dropped = self.source.dropped
+        finally:
+            self.source.release()
+        if dropped > self.reported:
+            record = logging.makeLogRecord({
+                'name': __name__,
+                'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': 'log queue full, dropped %d records (%d total)' %
+                       (dropped - self.reported, dropped),
+            })
+            self.reported = dropped
+            self.handle(record)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            self.report_drops()
+            self.handle(record)
+        self.report_drops()
+
+    def flush(self):
+        """write pending records synchronously, writer must not run"""
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if record is not self._sentinel:
+                self.handle(record)
+        self.report_drops()
+
+    def stop(self):
+        """flush pending records and wait for the writer to finish"""
+        if not self.is_alive():
+            self.flush()
+            return
+        try:
+            self.queue.put(self._sentinel, timeout=1.0)
+        except Queue.Full:
+            return
+        self.join(5.0)
+
+
+def setup(level, filename='', maxsize=1000):
+    """
+    Configure root logger to use a bounded queue.
+
+    Returns the writer thread, which has to be started by the process
+    running the event loop (i.e. after daemonizing).
+    """
+    if maxsize < 1:
+        # Queue.Queue treats sizes below 1 as unbounded
+        raise ValueError('log buffer size must be positive: %d' % maxsize)
+    if filename:
+        target = logging.FileHandler(filename)
+    else:
+        target = logging.StreamHandler()
+    target.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    queue = Queue.Queue(maxsize)
+    handler = QueueHandler(queue)
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    writer = QueueWriter(queue, [target], handler)
+    atexit.register(writer.stop)
+    return writer
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""
+Relay pool, spreads reinjection over several SMTP relays
+"""
+
+import logging
+import random
+import smtplib
+import socket
+import threading
+import time
+
+
+class Relay(object):
+    """
+    A single relay host with its health state and metrics
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.healthy = True
+        self.fails = 0
+        self.ejected_until = 0.0
+        self.sent = 0
+        self.errors = 0
+        self.check_errors = 0
+        self.latency = 0.0      # moving average in seconds
+        self.samples = 0
+
+    def __str__(self):
+        return '%s:%d' % (self.host, self.port)
+
+    def stats(self):
+        """returns metrics as dict"""
+        return {
+            'relay': str(self),
+            'healthy': self.healthy,
+            'sent': self.sent,
+            'errors': self.errors,
+            'check_errors': self.check_errors,
+            'latency_ms': self.latency * 1000.0,
+        }
+
+
+def refuse_all(rcpttos, code, resp):
+    """refusal dict for all recipients"""
+    return dict((rcpt, (code, resp)) for rcpt in rcpttos)
+
+
+class RelayPool(object):
+    """
+    Chooses relays by round robin or latency, ejects relays after
+    repeated failures and reinstates them later.
+
+    The latency strategy picks the faster of two random relays, so load
+    is shifted towards fast relays without starving the others.
+    """
+    STRATEGIES = ('roundrobin', 'latency')
+    # consecutive failures until a relay is ejected
+    MAX_FAILS = 3
+    # seconds an ejected relay is skipped
+    EJECT_TIME = 30.0
+    # weight of a new sample in latency average
+    ALPHA = 0.2
+    # latency sample (seconds) accounted for a failure
+    FAIL_LATENCY = 5.0
+    # socket timeouts, delivery blocks the asyncore loop
+    CONNECT_TIMEOUT = 5.0
+    TIMEOUT = 30.0
+
+    def __init__(self, addresses, strategy='roundrobin'):
+        if strategy not in self.STRATEGIES:
+            raise ValueError('unknown strategy %s' % strategy)
+        self.relays = [Relay(host, port) for host, port in addresses]
+        self.strategy = strategy
+        self.next = 0
+        self.lock = threading.Lock()
+        self.log = logging.getLogger(__name__ + ".RelayPool")
+
+    def _available(self):
+        """healthy relays, half-open those whose ejection expired"""
+        now = time.time()
+        for relay in self.relays:
+            if not relay.healthy and relay.ejected_until <= now:
+                # a single further failure ejects it again
+                self.log.info('relay %s reinstated on probation', relay)
+                relay.healthy = True
+                relay.fails = self.MAX_FAILS - 1
+        return [relay for relay in self.relays if relay.healthy]
+
+    def candidates(self):
+        """returns relays in order of preference"""
+        with self.lock:
+            relays = self._available()
+            if not relays:
+                # better try an ejected relay than fail for sure
+                relays = list(self.relays)
+            if self.strategy == 'latency':
+                relays = list(relays)
+                random.shuffle(relays)
+                # unmeasured relays keep their random position
+                if len(relays) > 1 and relays[0].samples and \
+                        relays[1].samples and \
+                        relays[1].latency < relays[0].latency:
+                    relays[0], relays[1] = relays[1], relays[0]
+                return relays
+            start = self.next % len(relays)
+            self.next += 1
+            return relays[start:] + relays[:start]
+
+    def _update_latency(self, relay, elapsed):
+        """add sample to moving average, lock must be held"""
+        if relay.samples:
+            relay.latency += self.ALPHA * (elapsed - relay.latency)
+        else:
+            relay.latency = elapsed
+        relay.samples += 1
+
+    def mark_ok(self, relay, elapsed):
+        """passive check: relay handled the transaction"""
+        with self.lock:
+            relay.sent += 1
+            relay.fails = 0
+            self._update_latency(relay, elapsed)
+            if not relay.healthy:
+                self.log.info('relay %s delivered, reinstated', relay)
+                relay.healthy = True
+
+    def mark_skipped(self, relay):
+        """relay passed the message on, not counted as failure"""
+        with self.lock:
+            self._update_latency(relay, self.FAIL_LATENCY)
+
+    def mark_failed(self, relay, err, check=False):
+        """passive or active check: relay failed"""
+        with self.lock:
+            if check:
+                relay.check_errors += 1
+            else:
+                relay.errors += 1
+            relay.fails += 1
+            self._update_latency(relay, self.FAIL_LATENCY)
+            if not relay.healthy:
+                relay.ejected_until = time.time() + self.EJECT_TIME
+            elif relay.fails >= self.MAX_FAILS:
+                relay.healthy = False
+                relay.ejected_until = time.time() + self.EJECT_TIME
+                self.log.warning('relay %s ejected after %d failures: %s',
+                                 relay, relay.fails, err)
+
+    def _refused(self, relay, start, rcpttos, code, resp, sent,
+                 relay_error=True):
+        """
+        Handle a negative reply. Returns refused recipients and whether
+        the message may be passed to the next relay. Temporary errors
+        count against the relay unless relay_error is False.
+        """
+        if code >= 500:
+            # the message is rejected, not the relay
+            self.mark_ok(relay, time.time() - start)
+            return refuse_all(rcpttos, code, resp), False
+        if relay_error or code == 421:
+            self.mark_failed(relay, '%d %s' % (code, resp))
+        else:
+            self.mark_skipped(relay)
+        return refuse_all(rcpttos, code, resp), not sent
+
+    def _send(self, relay, mailfrom, rcpttos, data):
+        """
+        Deliver message over one relay. Returns refused recipients and
+        whether the message may be passed to the next relay, which is
+        only the case if the relay did not get the message data.
+        """
+        start = time.time()
+        conn = None
+        try:
+            conn = smtplib.SMTP(relay.host, relay.port,
+                                timeout=self.CONNECT_TIMEOUT)
+            conn.sock.settimeout(self.TIMEOUT)
+            conn.ehlo_or_helo_if_needed()
+        except (socket.error, smtplib.SMTPException) as err:
+            if conn is not None:
+                conn.close()
+            self.mark_failed(relay, err)
+            return refuse_all(rcpttos, getattr(err, 'smtp_code', -1),
+                              getattr(err, 'smtp_error', str(err))), True
+
+        sent = False
+        try:
+            opts = []
+            if conn.does_esmtp and conn.has_extn('size'):
+                opts.append('size=%d' % len(data))
+            code, resp = conn.mail(mailfrom, opts)
+            if code != 250:
+                return self._refused(relay, start, rcpttos, code, resp, sent)
+            refused = {}
+            for rcpt in rcpttos:
+                code, resp = conn.rcpt(rcpt)
+                if code in (250, 251):
+                    continue
+                if code < 500:
+                    # may be specific to the recipient
+                    return self._refused(relay, start, rcpttos, code, resp,
+                                         sent, relay_error=False)
+                refused[rcpt] = (code, resp)
+            if len(refused) == len(rcpttos):
+                self.mark_ok(relay, time.time() - start)
+                return refused, False
+            try:
+                sent = True
+                code, resp = conn.data(data)
+            except smtplib.SMTPDataError as err:
+                # DATA command refused, message not transmitted
+                sent = False
+                return self._refused(relay, start, rcpttos, err.smtp_code,
+                                     err.smtp_error, sent)
+            if code != 250:
+                return self._refused(relay, start, rcpttos, code, resp, sent)
+            self.mark_ok(relay, time.time() - start)
+            return refused, False
+        except (socket.error, smtplib.SMTPException) as err:
+            # if the message was sent it may already be accepted,
+            # don't resend it
+            self.mark_failed(relay, err)
+            conn.close()
+            return refuse_all(rcpttos, -1, str(err)), not sent
+        finally:
+            try:
+                conn.quit()
+            except (socket.error, smtplib.SMTPException):
+                conn.close()
+
+    def deliver(self, mailfrom, rcpttos, data):
+        """
+        Send message to the first working relay, returns dict of
+        refused recipients like smtplib.SMTP.sendmail
+        """
+        refused = {}
+        for relay in self.candidates():
+            refused, retry = self._send(relay, mailfrom, rcpttos, data)
+            if not retry:
+                break
+        return refused
+
+    def check(self, relay):
+        """active check: connect and send NOOP"""
+        try:
+            conn = smtplib.SMTP(relay.host, relay.port,
+                                timeout=self.CONNECT_TIMEOUT)
+            try:
+                code = conn.noop()[0]
+            finally:
+                try:
+                    conn.quit()
+                except (socket.error, smtplib.SMTPException):
+                    conn.close()
+        except (socket.error, smtplib.SMTPException) as err:
+            self.mark_failed(relay, err, check=True)
+            return False
+        if code != 250:
+            self.mark_failed(relay, 'NOOP returned %d' % code, check=True)
+            return False
+        with self.lock:
+            relay.fails = 0
+            if not relay.healthy:
+                self.log.info('relay %s passed check, reinstated', relay)
+                relay.healthy = True
+        return True
+
+    def stats(self):
+        """returns metrics of all relays"""
+        with self.lock:
+            return [relay.stats() for relay in self.relays]
+
+
+class RelayChecker(threading.Thread):
+    """
+    Thread checking all relays periodically and logging their metrics
+    """
+    def __init__(self, pool, interval):
+        threading.Thread.__init__(self, name='relaychecker')
+        self.daemon = True
+        self.pool = pool
+        self.interval = interval
+        self.log = logging.getLogger(__name__ + ".RelayChecker")
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            for relay in self.pool.relays:
+                self.pool.check(relay)
+            for stats in self.pool.stats():
+                self.log.info('relay=%(relay)s healthy=%(healthy)s '
+                              'sent=%(sent)d errors=%(errors)d '
+                              'check_errors=%(check_errors)d '
+                              'latency_ms=%(latency_ms).1f', stats,
+                              extra=stats)
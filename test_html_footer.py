@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Tests for command line parsing and SMTP answers of html_footer
+"""
+
+import StringIO
+import sys
+import unittest
+
+import html_footer
+
+
+class ParseArgsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.argv = sys.argv
+        self.stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.argv = self.argv
+        sys.stderr = self.stderr
+
+    def parse(self, *args):
+        sys.argv = ['html_footer.py'] + list(args)
+        return html_footer.parseargs()
+
+    def test_default_remote(self):
+        self.assertEqual(self.parse().remote, [('127.0.0.1', 25)])
+
+    def test_remote_list(self):
+        options = self.parse('-r', 'a:25,b:26')
+        self.assertEqual(options.remote, [('a', 25), ('b', 26)])
+
+    def test_remote_repeated(self):
+        options = self.parse('-r', 'a:25', '--remote', 'b:26,c:27')
+        self.assertEqual(options.remote, [('a', 25), ('b', 26), ('c', 27)])
+
+    def test_bad_remote(self):
+        self.assertRaises(SystemExit, self.parse, '-r', 'a:25,b')
+        self.assertRaises(SystemExit, self.parse, '-r', 'a:x')
+
+    def test_balance(self):
+        self.assertEqual(self.parse('-a', 'latency').balance, 'latency')
+        self.assertRaises(SystemExit, self.parse, '-a', 'random')
+
+    def test_checkinterval(self):
+        self.assertEqual(self.parse('-c', '2.5').checkinterval, 2.5)
+        self.assertRaises(SystemExit, self.parse, '-c', 'x')
+
+    def test_logbuffer(self):
+        self.assertEqual(self.parse('-b', '10').logbuffer, 10)
+        self.assertRaises(SystemExit, self.parse, '-b', '0')
+
+    def test_dumpsample(self):
+        self.assertEqual(self.parse('-s', '10').dumpsample, 10)
+        self.assertRaises(SystemExit, self.parse, '-s', '0')
+
+
+class RefusalReplyTest(unittest.TestCase):
+
+    def test_nothing_refused(self):
+        self.assertEqual(html_footer.refusal_reply(['a'], {}), None)
+
+    def test_all_temporary(self):
+        refused = {'a': (421, 'busy'), 'b': (-1, 'connection refused')}
+        self.assertTrue(
+            html_footer.refusal_reply(['a', 'b'], refused).startswith('451'))
+
+    def test_permanent(self):
+        refused = {'a': (421, 'busy'), 'b': (550, 'unknown user')}
+        self.assertTrue(
+            html_footer.refusal_reply(['a', 'b'], refused).startswith('550'))
+
+    def test_partly_refused(self):
+        refused = {'a': (451, 'try later')}
+        self.assertTrue(
+            html_footer.refusal_reply(['a', 'b'], refused).startswith('550'))
+
+
+if __name__ == '__main__':
+    unittest.main()
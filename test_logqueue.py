@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Tests for the queue based logging
+"""
+
+import logging
+import os
+import tempfile
+import unittest
+import Queue
+
+import logqueue
+
+
+class ListHandler(logging.Handler):
+    """collects formatted messages"""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class QueueHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = Queue.Queue(2)
+        self.handler = logqueue.QueueHandler(self.queue)
+        self.target = ListHandler()
+        self.writer = logqueue.QueueWriter(self.queue, [self.target],
+                                           self.handler)
+        self.log = logging.getLogger('test_logqueue')
+        self.log.propagate = False
+        self.log.setLevel(logging.DEBUG)
+        self.log.addHandler(self.handler)
+
+    def tearDown(self):
+        self.log.removeHandler(self.handler)
+        self.writer.stop()
+
+    def test_overflow_drops(self):
+        for i in range(5):
+            self.log.info('msg %d', i)
+        self.assertEqual(self.handler.dropped, 3)
+        self.writer.flush()
+        self.assertEqual(self.target.messages[:2], ['msg 0', 'msg 1'])
+        self.assertEqual(self.target.messages[2],
+                         'log queue full, dropped 3 records (3 total)')
+
+    def test_drops_reported_once(self):
+        for i in range(3):
+            self.log.info('msg %d', i)
+        self.writer.flush()
+        self.log.info('msg 3')
+        self.writer.flush()
+        self.assertEqual(self.target.messages,
+                         ['msg 0', 'msg 1',
+                          'log queue full, dropped 1 records (1 total)',
+                          'msg 3'])
+
+    def test_record_prepared(self):
+        args = {'key': 'before'}
+        self.log.info('value %(key)s', args)
+        args['key'] = 'after'
+        self.writer.flush()
+        self.assertEqual(self.target.messages, ['value before'])
+
+    def test_writer_thread(self):
+        self.writer.start()
+        self.log.info('threaded')
+        self.writer.stop()
+        self.assertFalse(self.writer.is_alive())
+        self.assertEqual(self.target.messages, ['threaded'])
+
+    def test_flush_before_fork(self):
+        # same sequence as FooterDaemon.daemonize: flush, then fork;
+        # the child drains its copy of the queue, the parent flushes
+        # again on exit
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        target = logging.FileHandler(path)
+        self.writer.handlers = [target]
+        self.log.info('pending')
+        self.writer.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.writer.flush()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.writer.stop()
+        target.close()
+        with open(path) as logfile:
+            self.assertEqual(logfile.read(), 'pending\n')
+
+    def test_setup_rejects_unbounded(self):
+        self.assertRaises(ValueError, logqueue.setup, logging.INFO, '', 0)
+        self.assertRaises(ValueError, logqueue.setup, logging.INFO, '', -1)
+
+
+if __name__ == '__main__':
+    unittest.main()
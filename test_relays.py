@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+"""
+Tests for the relay pool, using fake SMTP relays on localhost
+"""
+
+import logging
+import smtplib
+import socket
+import threading
+import time
+import unittest
+
+import relays
+
+logging.getLogger('relays').addHandler(logging.NullHandler())
+
+
+class FakeRelay(threading.Thread):
+    """
+    Minimal SMTP server answering commands from a reply table.
+    Keys are the upper case command verbs, 'DATA' is the reply to the
+    DATA command and 'DOT' the reply after the message data.
+    """
+    DEFAULTS = {
+        'GREETING': '220 fake ESMTP',
+        'EHLO': '250 fake',
+        'HELO': '250 fake',
+        'MAIL': '250 ok',
+        'RCPT': '250 ok',
+        'DATA': '354 go ahead',
+        'DOT': '250 queued',
+        'NOOP': '250 ok',
+        'RSET': '250 ok',
+        'QUIT': '221 bye',
+    }
+
+    def __init__(self, **replies):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.replies = dict(self.DEFAULTS)
+        self.replies.update(replies)
+        self.commands = []
+        self.messages = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.address = self.sock.getsockname()
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                conn = self.sock.accept()[0]
+            except socket.error:
+                return
+            try:
+                self.session(conn.makefile('rb'), conn)
+            except socket.error:
+                pass
+            conn.close()
+
+    def reply(self, conn, key):
+        conn.sendall(self.replies[key] + '\r\n')
+        return self.replies[key].startswith('421')
+
+    def session(self, rfile, conn):
+        if self.reply(conn, 'GREETING'):
+            return
+        while True:
+            line = rfile.readline()
+            if not line:
+                return
+            verb = line.split()[0].upper()
+            self.commands.append(verb)
+            if verb == 'DATA':
+                if self.reply(conn, 'DATA'):
+                    return
+                if not self.replies['DATA'].startswith('354'):
+                    continue
+                data = []
+                while True:
+                    line = rfile.readline()
+                    if line in ('.\r\n', ''):
+                        break
+                    data.append(line)
+                self.messages.append(''.join(data))
+                verb = 'DOT'
+            if self.reply(conn, verb) or verb == 'QUIT':
+                return
+
+    def close(self):
+        self.sock.close()
+
+
+def dead_address():
+    """address nobody listens on"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    return address
+
+
+MESSAGE = 'Subject: test\r\n\r\nbody\r\n'
+
+
+class RelayPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fakes = []
+
+    def tearDown(self):
+        for fake in self.fakes:
+            fake.close()
+
+    def fake(self, **replies):
+        fake = FakeRelay(**replies)
+        self.fakes.append(fake)
+        return fake
+
+    def pool(self, *addresses, **kwargs):
+        pool = relays.RelayPool(addresses, **kwargs)
+        # keep the order of candidates predictable
+        pool.next = 0
+        return pool
+
+    def deliver(self, pool, rcpttos=('r@z',)):
+        return pool.deliver('s@z', list(rcpttos), MESSAGE)
+
+    def test_unknown_strategy(self):
+        self.assertRaises(ValueError, relays.RelayPool,
+                          [('127.0.0.1', 25)], 'random')
+
+    def test_roundrobin_order(self):
+        pool = self.pool(('a', 1), ('b', 2), ('c', 3))
+        first = [str(r) for r in pool.candidates()]
+        second = [str(r) for r in pool.candidates()]
+        self.assertEqual(first, ['a:1', 'b:2', 'c:3'])
+        self.assertEqual(second, ['b:2', 'c:3', 'a:1'])
+
+    def test_latency_prefers_faster(self):
+        pool = self.pool(('a', 1), ('b', 2), strategy='latency')
+        pool.mark_ok(pool.relays[0], 1.0)
+        pool.mark_ok(pool.relays[1], 0.1)
+        for i in range(10):
+            self.assertEqual(str(pool.candidates()[0]), 'b:2')
+
+    def test_unmeasured_not_preferred(self):
+        pool = self.pool(('a', 1), ('b', 2), strategy='latency')
+        pool.mark_ok(pool.relays[0], 1.0)
+        first = set(str(pool.candidates()[0]) for i in range(50))
+        self.assertEqual(first, set(['a:1', 'b:2']))
+
+    def test_failure_penalizes_latency(self):
+        pool = self.pool(('a', 1))
+        relay = pool.relays[0]
+        pool.mark_ok(relay, 0.1)
+        pool.mark_failed(relay, 'error')
+        self.assertTrue(relay.latency > 0.1)
+
+    def test_ejection_and_probation(self):
+        pool = self.pool(('a', 1), ('b', 2))
+        relay = pool.relays[0]
+        for i in range(pool.MAX_FAILS):
+            pool.mark_failed(relay, 'error')
+        self.assertFalse(relay.healthy)
+        self.assertEqual([str(r) for r in pool.candidates()], ['b:2'])
+
+        relay.ejected_until = time.time() - 1
+        self.assertEqual(len(pool.candidates()), 2)
+        self.assertTrue(relay.healthy)
+        # reinstated relay is ejected again by a single failure
+        pool.mark_failed(relay, 'error')
+        self.assertFalse(relay.healthy)
+
+    def test_all_ejected_still_tried(self):
+        pool = self.pool(('a', 1))
+        for i in range(pool.MAX_FAILS):
+            pool.mark_failed(pool.relays[0], 'error')
+        self.assertEqual(len(pool.candidates()), 1)
+
+    def test_delivery_reinstates_ejected(self):
+        fake = self.fake()
+        pool = self.pool(fake.address)
+        relay = pool.relays[0]
+        for i in range(pool.MAX_FAILS):
+            pool.mark_failed(relay, 'error')
+        self.assertEqual(self.deliver(pool), {})
+        self.assertTrue(relay.healthy)
+
+    def test_close_after_helo_error(self):
+        closed = []
+        base = smtplib.SMTP
+
+        class SMTP(base):
+            def close(self):
+                closed.append(self)
+                base.close(self)
+
+        self.addCleanup(setattr, smtplib, 'SMTP', base)
+        smtplib.SMTP = SMTP
+        fake = self.fake(EHLO='554 go away', HELO='554 go away')
+        pool = self.pool(fake.address)
+        self.assertEqual(self.deliver(pool)['r@z'][0], 554)
+        self.assertEqual(len(closed), 1)
+        self.assertEqual(pool.relays[0].errors, 1)
+
+    def test_deliver(self):
+        fake = self.fake()
+        pool = self.pool(fake.address)
+        self.assertEqual(self.deliver(pool), {})
+        self.assertEqual(len(fake.messages), 1)
+        self.assertEqual(pool.relays[0].sent, 1)
+
+    def test_failover_on_connect_error(self):
+        fake = self.fake()
+        pool = self.pool(dead_address(), fake.address)
+        self.assertEqual(self.deliver(pool), {})
+        self.assertEqual(len(fake.messages), 1)
+        self.assertEqual(pool.relays[0].errors, 1)
+
+    def test_failover_on_busy_relay(self):
+        busy = self.fake(MAIL='421 4.3.2 busy')
+        fake = self.fake()
+        pool = self.pool(busy.address, fake.address)
+        self.assertEqual(self.deliver(pool), {})
+        self.assertEqual(len(fake.messages), 1)
+        self.assertEqual(pool.relays[0].errors, 1)
+
+    def test_failover_on_temporary_mail(self):
+        full = self.fake(MAIL='452 4.3.1 insufficient storage')
+        fake = self.fake()
+        pool = self.pool(full.address, fake.address)
+        for i in range(pool.MAX_FAILS):
+            pool.next = 0
+            self.assertEqual(self.deliver(pool), {})
+        relay = pool.relays[0]
+        self.assertEqual(relay.errors, pool.MAX_FAILS)
+        self.assertFalse(relay.healthy)
+        self.assertTrue(relay.latency > 0)
+        self.assertEqual(len(fake.messages), pool.MAX_FAILS)
+
+    def test_failover_on_temporary_data(self):
+        busy = self.fake(DATA='451 4.3.0 try later')
+        fake = self.fake()
+        pool = self.pool(busy.address, fake.address)
+        self.assertEqual(self.deliver(pool), {})
+        self.assertEqual(len(fake.messages), 1)
+        self.assertEqual(pool.relays[0].errors, 1)
+
+    def test_failover_on_temporary_rcpt(self):
+        busy = self.fake(RCPT='451 4.3.0 try later')
+        fake = self.fake()
+        pool = self.pool(busy.address, fake.address)
+        self.assertEqual(self.deliver(pool), {})
+        self.assertEqual(len(fake.messages), 1)
+        self.assertEqual(busy.messages, [])
+        self.assertEqual(pool.relays[0].errors, 0)
+        self.assertEqual(pool.relays[0].samples, 1)
+
+    def test_all_busy(self):
+        busy = self.fake(MAIL='421 4.3.2 busy')
+        pool = self.pool(busy.address)
+        self.assertEqual(self.deliver(pool), {'r@z': (421, '4.3.2 busy')})
+
+    def test_content_rejected_keeps_relay(self):
+        spam = self.fake(DOT='550 5.7.1 spam content rejected')
+        fake = self.fake()
+        pool = self.pool(spam.address, fake.address)
+        for i in range(pool.MAX_FAILS + 1):
+            pool.next = 0
+            refused = self.deliver(pool)
+            self.assertEqual(refused['r@z'][0], 550)
+        relay = pool.relays[0]
+        self.assertTrue(relay.healthy)
+        self.assertEqual(relay.errors, 0)
+        self.assertEqual(fake.messages, [])
+
+    def test_sender_refused_keeps_relay(self):
+        fake = self.fake(MAIL='553 5.1.8 sender rejected')
+        pool = self.pool(fake.address)
+        self.assertEqual(self.deliver(pool)['r@z'][0], 553)
+        self.assertEqual(pool.relays[0].errors, 0)
+
+    def test_recipients_refused(self):
+        fake = self.fake(RCPT='550 5.1.1 unknown user')
+        pool = self.pool(fake.address)
+        refused = self.deliver(pool, ['a@z', 'b@z'])
+        self.assertEqual(sorted(refused), ['a@z', 'b@z'])
+        self.assertEqual(fake.messages, [])
+        self.assertEqual(pool.relays[0].errors, 0)
+
+    def test_no_resend_after_data(self):
+        first = self.fake(DOT='451 4.3.0 error after data')
+        second = self.fake()
+        pool = self.pool(first.address, second.address)
+        self.assertEqual(self.deliver(pool)['r@z'][0], 451)
+        self.assertEqual(len(first.messages), 1)
+        self.assertEqual(second.messages, [])
+
+    def test_check(self):
+        fake = self.fake()
+        pool = self.pool(fake.address)
+        relay = pool.relays[0]
+        relay.healthy = False
+        relay.ejected_until = time.time() + 60
+        self.assertTrue(pool.check(relay))
+        self.assertTrue(relay.healthy)
+        self.assertEqual(fake.commands[-1], 'QUIT')
+
+    def test_check_errors_separate(self):
+        pool = self.pool(dead_address())
+        relay = pool.relays[0]
+        self.assertFalse(pool.check(relay))
+        self.assertEqual(relay.check_errors, 1)
+        self.assertEqual(relay.errors, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()